@@ -17,3 +17,5 @@ logging.basicConfig(filename='debug.log', format='%(asctime)s: %(message)s',
 					level=logging.INFO)
 
 from e24py.apiobjects import E24sess, VirtualMachine, StorageVolume, DiscImage
+from e24py.pipeline import Pipeline, PipelineFailed
+from e24py.pool import SessionPool, SharedCache
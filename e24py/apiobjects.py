@@ -3,6 +3,7 @@ for for API resources, and interacts with the API through e24sess class.
 """
 
 import logging
+import time
 
 from .session import E24sess, ApiRequestFailed
 from .globals import TYPEMAP
@@ -14,7 +15,7 @@ class ApiObject():
     resources. Also includes handler for proper session object.
     """
 
-    def __init__(self, type, id="", label="", session=None):
+    def __init__(self, type, id="", label="", session=None, data=None):
 
         if not session:
             # We cant put default session directly in init parameters, since default session is always empty on import.
@@ -25,7 +26,8 @@ class ApiObject():
         if not id and not label:
             raise ValueError('Cannot find resource without ID or label.')
 
-        request = self.session.resource_search(type, id, label)
+        # Data already fetched by a list request spares us another GET.
+        request = data or self.session.resource_search(type, id, label)
         if not request:
             raise ApiRequestFailed("No resource found!", self.session)
 
@@ -46,7 +48,15 @@ class ApiObject():
         url = "/v2/{}/{}".format(TYPEMAP[self.type]['urlname'], self.id)
 
         r = self.session.api_request("GET", url)
-        self.data = r.json()[self.type]
+        self._apply_data(r.json()[self.type])
+
+    def _apply_data(self, data):
+        """Sets instance attributes from a fresh resource payload. Shared by
+        update() and E24sess.refresh(), which gets payloads from list requests.
+        Only plain scalar fields are copied, attributes holding other ApiObjects
+        (like VirtualMachine.storage_volumes) are rebuilt by subclasses.
+        """
+        self.data = data
 
         attributes = [attribute for attribute in dir(self) if not callable(getattr(self, attribute)) and not attribute.startswith("__")]
 
@@ -56,7 +66,24 @@ class ApiObject():
         attributes.remove('session')
 
         for attribute in attributes:
-            setattr(self, attribute, self.data[attribute])
+            if attribute in self.data and not isinstance(self.data[attribute], (dict, list)):
+                setattr(self, attribute, self.data[attribute])
+
+    def wait_for(self, key, value, timeout=300, interval=5):
+        """Polls the API with update() until data[key] equals value. Raises
+        ApiRequestFailed if it does not happen within timeout seconds. Useful
+        as a pipeline step, e.g. waiting for a vm to come online.
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            self.update()
+            if self.data.get(key) == value:
+                return self
+            if time.monotonic() >= deadline:
+                raise ApiRequestFailed("{} {} did not reach {}={} in {}s".format(
+                    self.type, self.id, key, value, timeout), self.session)
+            time.sleep(interval)
 
     def delete(self):
         url = "/v2/{}/{}".format(TYPEMAP[self.type]['urlname'], self.id)
@@ -78,12 +105,26 @@ class VirtualMachine(ApiObject):
         self.ram = self.data['ram']
         self.storage_volumes = [StorageVolume(storage['id'], session=self.session) for storage in self.data['storage_volumes']]
 
+    def _apply_data(self, data):
+        super()._apply_data(data)
+
+        # Reuse StorageVolume objects already registered in the session, or
+        # build them from the inventory if refresh() has just listed volumes.
+        volumes = []
+        for storage in self.data.get('storage_volumes', []):
+            volume = self.session.objects.get(storage['id'])
+            if not isinstance(volume, StorageVolume):
+                volume = StorageVolume(storage['id'], session=self.session,
+                                       data=self.session.inventory.get('storage_volume', storage['id']))
+            volumes.append(volume)
+        self.storage_volumes = volumes
+
     def delete(self):
         super(VirtualMachine, self).delete()
 
         for volume in self.storage_volumes:
 
-            del self.session.objects[volume.id]
+            self.session.objects.pop(volume.id, None)
             # Volume is deleted, we tidy up conn.objects
 
     def power_on(self):
@@ -112,9 +153,9 @@ class VirtualMachine(ApiObject):
 class StorageVolume(ApiObject):
     """Represents a storage resource."""
 
-    def __init__(self,  id='', label='', session=E24sess.default_session):
+    def __init__(self,  id='', label='', session=E24sess.default_session, data=None):
         super().__init__(type='storage_volume', id=id, label=label,
-                         session=session)
+                         session=session, data=data)
         self.size = self.data['size']
 
     def attach(self, vmid):
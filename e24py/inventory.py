@@ -0,0 +1,227 @@
+"""Contains Inventory and Query classes.
+
+Inventory is a local cache of list payloads returned by the API (the same ones
+resource_search and refresh already fetch), stored by columns rather than as a
+list of dictionaries. Commonly filtered fields have secondary indexes: a hash
+index for exact matches and a sorted index for range filters, so queries only
+touch matching rows instead of scanning every record.
+"""
+
+from bisect import bisect_left, bisect_right
+
+
+INDEXED = ('state', 'cores', 'ram', 'size', 'label')
+
+OPERATORS = {'exact', 'in', 'gt', 'gte', 'lt', 'lte'}
+
+
+class Table():
+    """Column-oriented storage of all resources of one type. Nested fields
+    can be accessed with dotted names (e.g. "virtual_machine.id"), their
+    columns are built on first use."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.ids = [row['id'] for row in self.rows]
+        self.by_id = {id: position for position, id in enumerate(self.ids)}
+        self.columns = {}
+        self.hash_indexes = {}
+        self.sorted_indexes = {}
+
+        fields = set()
+        for row in self.rows:
+            fields.update(row)
+        for field in fields:
+            self.column(field)
+        for field in INDEXED:
+            if field in self.columns:
+                self._build_indexes(field)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, field):
+        if field not in self.columns:
+            self.columns[field] = [_resolve(row, field) for row in self.rows]
+        return self.columns[field]
+
+    def _build_indexes(self, field):
+        """Builds indexes for field. Each index is only kept if it covers every
+        value in the column, otherwise filters on field fall back to scanning.
+        """
+        hash_index = {}
+        pairs = []
+        hashable = True
+        numeric = True
+        for position, value in enumerate(self.columns[field]):
+            try:
+                hash_index.setdefault(value, set()).add(position)
+            except TypeError:
+                hashable = False
+            if value is None:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                pairs.append((value, position))
+            else:
+                numeric = False
+
+        if hashable:
+            self.hash_indexes[field] = hash_index
+        if numeric:
+            pairs.sort()
+            self.sorted_indexes[field] = ([value for value, _ in pairs],
+                                          [position for _, position in pairs])
+
+    def select(self, field, operator, value):
+        """Returns a set of row positions matching a single filter."""
+        if operator not in OPERATORS:
+            raise ValueError("Unknown operator: {}".format(operator))
+        if operator == 'in' and isinstance(value, str):
+            raise ValueError("Value for {}__in must be a list, not a string.".format(field))
+
+        try:
+            if operator == 'exact' and field in self.hash_indexes:
+                return set(self.hash_indexes[field].get(value, ()))
+            if operator == 'in' and field in self.hash_indexes:
+                positions = set()
+                for item in value:
+                    positions.update(self.hash_indexes[field].get(item, ()))
+                return positions
+        except TypeError:
+            pass  # unhashable value, can only be compared by scanning
+        if field in self.sorted_indexes and operator in ('gt', 'gte', 'lt', 'lte'):
+            keys, positions = self.sorted_indexes[field]
+            if operator == 'gt':
+                return set(positions[bisect_right(keys, value):])
+            if operator == 'gte':
+                return set(positions[bisect_left(keys, value):])
+            if operator == 'lt':
+                return set(positions[:bisect_left(keys, value)])
+            return set(positions[:bisect_right(keys, value)])
+
+        return {position for position, item in enumerate(self.column(field))
+                if _compare(item, operator, value)}
+
+
+class Inventory():
+    """Per-type cache of Tables, filled by E24sess from list payloads."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def __repr__(self):
+        return "{} object tables={} at {}".format(
+            __class__.__name__, {type: len(table) for type, table in self.tables.items()},
+            hex(id(self)))
+
+    def __contains__(self, type):
+        return type in self.tables
+
+    def load(self, type, payloads):
+        self.tables[type] = Table(payloads)
+
+    def query(self, type):
+        return Query(self.tables[type])
+
+    def get(self, type, id):
+        """Returns cached json data of a single resource, or None."""
+        table = self.tables.get(type)
+        if table is None or id not in table.by_id:
+            return None
+        return table.rows[table.by_id[id]]
+
+
+class Query():
+    """
+    Chainable, immutable query over a single Table. Filters passed to where()
+    use Django-like syntax: field=value for exact match, or field__operator=value
+    where operator is one of in, gt, gte, lt, lte. Multiple filters are
+    combined with AND."""
+
+    def __init__(self, table, positions=None):
+        self.table = table
+        self.positions = positions
+
+    def __repr__(self):
+        return "{} object matching {} of {} rows at {}".format(
+            __class__.__name__, len(self._positions()), len(self.table), hex(id(self)))
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def where(self, **filters):
+        positions = self.positions
+        for key, value in filters.items():
+            field, _, operator = key.partition('__')
+            selected = self.table.select(field, operator or 'exact', value)
+            positions = selected if positions is None else positions & selected
+        return Query(self.table, positions)
+
+    def _positions(self):
+        if self.positions is None:
+            return range(len(self.table))
+        return sorted(self.positions)
+
+    def all(self):
+        """Returns json data of all matching resources."""
+        return [self.table.rows[position] for position in self._positions()]
+
+    def ids(self):
+        return [self.table.ids[position] for position in self._positions()]
+
+    def values(self, field):
+        column = self.table.column(field)
+        return [column[position] for position in self._positions()]
+
+    def count(self, by=None):
+        """Returns the number of matching resources, or a dictionary of counts
+        per value of the by field.
+        """
+        if not by:
+            return len(self._positions())
+
+        rv = {}
+        for key in self.values(by):
+            rv[key] = rv.get(key, 0) + 1
+        return rv
+
+    def sum(self, field, by=None):
+        """Returns the sum of field over matching resources, or a dictionary of
+        sums per value of the by field. Missing values are skipped.
+        """
+        values = self.values(field)
+        if not by:
+            return sum(value for value in values if value is not None)
+
+        rv = {}
+        for key, value in zip(self.values(by), values):
+            if value is not None:
+                rv[key] = rv.get(key, 0) + value
+        return rv
+
+
+def _resolve(row, field):
+    for part in field.split('.'):
+        if not isinstance(row, dict):
+            return None
+        row = row.get(part)
+    return row
+
+
+def _compare(item, operator, value):
+    if operator == 'exact':
+        return item == value
+    if operator == 'in':
+        return item in value
+    if item is None:
+        return False
+    if operator == 'gt':
+        return item > value
+    if operator == 'gte':
+        return item >= value
+    if operator == 'lt':
+        return item < value
+    return item <= value
@@ -0,0 +1,66 @@
+"""Contains LatencyStats class.
+
+LatencyStats keeps a window of recent response times for every API endpoint,
+which E24sess uses to decide how long to wait for a GET request before sending
+a hedged (duplicate) one.
+"""
+
+import threading
+
+from collections import deque
+
+
+class LatencyStats():
+    """
+    Per-endpoint latency statistics. Endpoints are keyed by method and path
+    with resource ids replaced by "*", so all vms share one entry. Until
+    min_samples responses are recorded for an endpoint, default is used as its
+    hedge delay."""
+
+    def __init__(self, window=100, min_samples=20, default=1.0, percentile=95):
+        self.window = window
+        self.min_samples = min_samples
+        self.default = default
+        self.percentile = percentile
+        self.samples = {}
+        self._lock = threading.Lock() # hedged requests record from threads
+
+    def __repr__(self):
+        return "{} object endpoints={}, percentile={} at {}".format(
+            __class__.__name__, len(self.samples), self.percentile, hex(id(self)))
+
+    def after_fork(self):
+        """Replaces the lock in a forked child, where it may have been held
+        by a thread that does not exist anymore."""
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(method, path):
+        """Returns endpoint key, e.g. "GET /v2/virtual-machines/*/poweron"."""
+        parts = path.strip('/').split('/')
+        # /v2/<collection>/<id>/<action>: every id follows a collection name
+        for i in range(2, len(parts), 2):
+            parts[i] = '*'
+        return "{} /{}".format(method, '/'.join(parts))
+
+    def record(self, key, seconds):
+        with self._lock:
+            if key not in self.samples:
+                self.samples[key] = deque(maxlen=self.window)
+            self.samples[key].append(seconds)
+
+    def get_percentile(self, key, percentile=None):
+        """Returns given percentile (by default self.percentile) of recorded
+        response times, or None if there are not enough samples.
+        """
+        with self._lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+
+        rank = (percentile or self.percentile) / 100 * (len(samples) - 1)
+        return samples[int(round(rank))]
+
+    def hedge_delay(self, key):
+        delay = self.get_percentile(key)
+        return self.default if delay is None else delay
@@ -0,0 +1,154 @@
+"""Contains Pipeline class and related exceptions.
+
+Pipeline lets us describe a multi-step workflow (create vm -> wait online ->
+detach volume -> create image -> delete vm) as a graph of dependent steps, and
+runs every step as soon as all of its dependencies are done. Independent
+branches (for example the same workflow for many VMs) run side by side in a
+thread pool, so the API is not left idle between steps.
+"""
+
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .session import ApiRequestFailed
+
+
+class PipelineFailed(Exception):
+    """Raised when a pipeline step fails after exhausting all of its retries.
+    Holds the name of the failed step, the original exception and results of
+    all steps that completed before the failure.
+    """
+    def __init__(self, step, error, results):
+        super().__init__("Step {} failed: {}".format(step, error))
+        self.step = step
+        self.error = error
+        self.results = results
+        logging.error("An {} exception occured: step {} failed with {}".format(
+            __class__.__name__, step, error))
+
+
+class Step():
+    """Single unit of work in a pipeline. Func is called with results of
+    all steps listed in requires, in the same order. Rollback, if provided, is
+    called with the result of this step when the pipeline fails later on.
+    """
+
+    def __init__(self, name, func, requires=(), retries=0, retry_delay=0,
+                 rollback=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.rollback = rollback
+
+    def __repr__(self):
+        return "{} {} requires={} at {}".format(
+            __class__.__name__, self.name, self.requires, hex(id(self)))
+
+    def run(self, *args):
+        """Calls step function, retrying it on ApiRequestFailed. Any other
+        exception is considered a bug in the step and is not retried.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.func(*args)
+            except ApiRequestFailed:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                logging.info("Step {} failed, retry {} of {}".format(
+                    self.name, attempt, self.retries))
+                time.sleep(self.retry_delay)
+
+
+class Pipeline():
+    """
+    Dependency graph of steps. Steps are added with add_step() and executed
+    with run(), which returns a dictionary of step results keyed by step name.
+    If any step fails, no new steps are started, rollback hooks of already
+    completed steps are called in reverse order of completion and
+    PipelineFailed is raised.
+
+    Steps are run in threads sharing the same E24sess, so they should only
+    call blocking API methods and must not rely on any shared mutable state
+    other than their inputs."""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.steps = {}
+
+    def __repr__(self):
+        return "{} object steps={}, max_workers={} at {}".format(
+            __class__.__name__, len(self.steps), self.max_workers, hex(id(self)))
+
+    def add_step(self, name, func, requires=(), retries=0, retry_delay=0,
+                 rollback=None):
+        """Registers a new step and returns its name, so it can be passed
+        directly to requires of following steps.
+        """
+        if name in self.steps:
+            raise ValueError("Step {} already exists.".format(name))
+        for dependency in requires:
+            if dependency not in self.steps:
+                raise ValueError("Step {} requires unknown step {}.".format(
+                    name, dependency))
+
+        self.steps[name] = Step(name, func, requires, retries, retry_delay,
+                                rollback)
+        return name
+
+    def run(self):
+        """Executes all steps, starting each one as soon as its dependencies
+        have finished. As add_step only accepts already registered
+        dependencies, the graph cannot contain cycles.
+        """
+        results = {}
+        completed = []
+        waiting = dict(self.steps)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting or running:
+                for name, step in list(waiting.items()):
+                    if all(dependency in results for dependency in step.requires):
+                        args = [results[dependency] for dependency in step.requires]
+                        running[executor.submit(step.run, *args)] = name
+                        del waiting[name]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as error:
+                        # Let already running steps finish, so their results
+                        # can be rolled back as well.
+                        for other in wait(running).done:
+                            try:
+                                results[running[other]] = other.result()
+                                completed.append(running[other])
+                            except Exception:
+                                pass
+                        self._rollback(completed, results)
+                        raise PipelineFailed(name, error, results)
+                    completed.append(name)
+                    logging.info("Step {} completed".format(name))
+
+        return results
+
+    def _rollback(self, completed, results):
+        """Calls rollback hooks of completed steps in reverse order. A failing
+        rollback is logged and does not stop the remaining ones.
+        """
+        for name in reversed(completed):
+            rollback = self.steps[name].rollback
+            if not rollback:
+                continue
+            try:
+                rollback(results[name])
+            except Exception as error:
+                logging.error("Rollback of step {} failed: {}".format(name, error))
@@ -0,0 +1,154 @@
+"""Contains SessionPool and SharedCache classes.
+
+SessionPool is meant for multiprocessing and pre-fork worker pools. Every
+process gets its own E24sess (and so its own requests.Session), created lazily
+after fork, while read-only data that is expensive to fetch - label index and
+templates catalog - is kept in a SharedCache, a directory of json files that all
+workers on a machine can read instead of asking the API again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import stat
+import time
+
+from .session import E24sess
+from .globals import APIKEY, ENDPOINTS
+
+
+class SharedCache():
+    """
+    File-backed key-value store shared between processes. Every key is a
+    separate json file, replaced atomically on write, so concurrent workers
+    never read a partially written value. Values older than max_age seconds
+    are considered missing. The directory is created private to the current
+    user, and an existing one is refused unless this user owns it and nobody
+    else can write to it."""
+
+    def __init__(self, path, max_age=300):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self._check_owner()
+
+    def _check_owner(self):
+        info = os.stat(self.path)
+        if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+            raise PermissionError("Cache directory {} is not owned by current user.".format(
+                self.path))
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError("Cache directory {} is writable by other users.".format(
+                self.path))
+
+    def __repr__(self):
+        return "{} object path={}, max_age={} at {}".format(
+            __class__.__name__, self.path, self.max_age, hex(id(self)))
+
+    def _file(self, key):
+        return os.path.join(self.path, "{}.json".format(key))
+
+    def get(self, key):
+        """Returns cached value, or None if it is missing or expired."""
+        try:
+            if time.time() - os.path.getmtime(self._file(key)) > self.max_age:
+                return None
+            with open(self._file(key)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(value, file)
+            os.replace(tmp, self._file(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self, key):
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class SessionPool():
+    """
+    Gives every process its own E24sess for given endpoint, so a pool can be
+    created before forking workers (or pickled to them) and used safely in
+    each of them. Read-only caches are shared through SharedCache stored in
+    cache_path, by default a directory in the system temp dir named after the
+    endpoint and a hash of the API key, so accounts never share cached ids."""
+
+    def __init__(self, endpoint="DC1/PUBLIC-1", cache_path=None, max_age=300,
+                 set_default=True):
+        if endpoint not in ENDPOINTS:
+            raise KeyError("Valid endpoints are: {}".format(ENDPOINTS.keys()))
+        if not cache_path:
+            account = hashlib.sha256(bytes(APIKEY or '', 'utf-8')).hexdigest()[:16]
+            cache_path = os.path.join(tempfile.gettempdir(), "e24py-{}-{}".format(
+                re.sub(r'\W', '_', endpoint), account))
+
+        self.endpoint = endpoint
+        self.set_default = set_default
+        self.cache = SharedCache(cache_path, max_age)
+        self._session = None
+        self._pid = None
+
+    def __repr__(self):
+        return "{} object endpoint={}, cache={} at {}".format(
+            __class__.__name__, self.endpoint, self.cache.path, hex(id(self)))
+
+    def __getstate__(self):
+        # Sessions are never sent to another process, it creates its own.
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def session(self):
+        """E24sess bound to the current process."""
+        if self._pid != os.getpid():
+            self._session = E24sess(self.endpoint, set_default=self.set_default)
+            self._pid = os.getpid()
+            logging.info("SessionPool created session for process {}".format(self._pid))
+        return self._session
+
+    def label_index(self, type, refresh=False):
+        """Returns a dictionary mapping labels of all resources of given type
+        to their ids. Built from a single list request and shared between
+        workers.
+        """
+        key = "labels-{}".format(type)
+        index = None if refresh else self.cache.get(key)
+
+        if index is None:
+            index = {}
+            for resource in self.session.list_resources(type):
+                # Same as resource_search, first resource with a label wins.
+                if resource['label'] is not None:
+                    index.setdefault(resource['label'], resource['id'])
+            self.cache.set(key, index)
+        return index
+
+    def resource_id(self, type, label):
+        """Returns id of resource with given label, or None if not found."""
+        return self.label_index(type).get(label)
+
+    def get_os(self, refresh=False):
+        """Cached version of E24sess.get_os(), shared between workers. Template
+        ids are always returned as strings, as json object keys are.
+        """
+        templates = None if refresh else self.cache.get("templates")
+
+        if templates is None:
+            templates = {str(id): template for id, template in self.session.get_os().items()}
+            self.cache.set("templates", templates)
+        return templates
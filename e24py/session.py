@@ -6,13 +6,20 @@ a range of utility methods that interact with the API.
 """
 
 import logging
+import os
+import threading
+import time
 
 import hmac, hashlib, base64
 import json
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from email.utils import formatdate
+from urllib.parse import urlsplit
 
 from .globals import APIKEY, APISECRET, ENDPOINTS, TYPEMAP
+from .inventory import Inventory
+from .latency import LatencyStats
 
 try:
     import requests
@@ -32,6 +39,10 @@ class ApiRequestFailed(Exception):
                 __class__.__name__, msg))
 
 
+class DeadlineExceeded(ApiRequestFailed):
+    """Raised when an API request does not finish before its deadline"""
+
+
 class E24sess():
     """
     Session class encapsulating all methods tied to making actual requests and
@@ -46,9 +57,20 @@ class E24sess():
             raise KeyError("Valid endpoints are: {}".format(ENDPOINTS.keys()))
 
         self.session = requests.Session() # request.Session is instance-bound
+        self._pid = os.getpid() # sockets cannot be shared after fork
         self.endpoint = endpoint
         self.objects = {}
         self.zone = None # lazy init
+        self.inventory = Inventory()
+        self.latency = LatencyStats()
+        self.deadline = None # default for api_request, in seconds
+        self.hedge = False # default for api_request
+        self.retries = 0 # GET retries on connection errors
+        self.retry_backoff = 0.5 # seconds before first retry, doubled after each
+        self.max_workers = 8 # threads for deadline-bound and hedged requests
+        self.timeout = 30 # socket timeout of requests sent from worker threads
+        self._executor = None # lazy init
+        self._executor_lock = threading.Lock()
         if set_default:
             E24sess.default_session = self
 
@@ -60,14 +82,55 @@ class E24sess():
         return "{} object default_session={}, endpoint={} at {}".format(
             __class__.__name__, is_default, self.endpoint, hex(id(self)))
 
-    def api_request(self, method, path, data=None):
+    def api_request(self, method, path, data=None, deadline=None, hedge=None):
         """
         This method creates a valid authorization header, and prepares all 
         data requeired to make an API request. It passess the data to 
-        request_dispatch that handles actually sending the request."""
-
+        request_dispatch that handles actually sending the request.
+
+        Deadline is the time in seconds the whole call, including retries of
+        GET requests on connection errors, may take before DeadlineExceeded is
+        raised. As requests only supports timeouts of single socket operations,
+        a request with a deadline is sent from a worker thread and abandoned
+        when the deadline passes. With hedge, a GET request that is not answered
+        within the p95 latency of its endpoint is sent again, and the first
+        response wins. Both default to session attributes of the same name."""
+
+        full_url = "https://{}{}".format(ENDPOINTS[self.endpoint], path)
+
+        if deadline is None:
+            deadline = self.deadline
+        if hedge is None:
+            hedge = self.hedge
+        hedge = hedge and method == "GET"
+        expires = time.monotonic() + deadline if deadline is not None else None
+
+        attempt = 0
+        while True:
+            # Signature contains the date, so every attempt is signed again.
+            headers = self._sign(method, path, data)
+            try:
+                if hedge or expires is not None:
+                    return self._timed_dispatch(method, headers, full_url, data,
+                                                expires, hedge)
+                return self._request_dispatch(method, headers, full_url, data)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                # Only GET is safe to repeat, other methods may have been applied
+                if method != "GET" or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logging.info("Request to {} failed with {}, retry {} of {}".format(
+                    full_url, error, attempt, self.retries))
+
+                backoff = self.retry_backoff * 2 ** (attempt - 1)
+                remaining = self._remaining(expires, full_url)
+                if remaining is not None:
+                    backoff = min(backoff, remaining)
+                time.sleep(backoff)
+
+    def _sign(self, method, path, data=None):
+        """Returns request headers with a valid authorization header."""
         short_url = ENDPOINTS[self.endpoint]
-        full_url = "https://{}{}".format(short_url, path)
 
         if data:
             authstring = "{}\n{}\n{}\n{}\n{}".format(method, short_url,
@@ -84,26 +147,40 @@ class E24sess():
         authstring = (base64.b64encode(authstring))
         authstring = bytes(APIKEY, 'utf-8') + b':' + authstring
 
-        headers = {
+        return {
             'Content-type': 'application/json',
             'X-Date': formatdate(usegmt=True),
             'Authorization': authstring
             }
 
-        return self._request_dispatch(method, headers, full_url, data)
-
-    def _request_dispatch(self, method, headers, url, data):
+    def _request_dispatch(self, method, headers, url, data, expires=None, timeout=None):
         """Sends the request prepared by previous method and makes sure the
-        response from the server is valid and succeded.
+        response from the server is valid and succeded. Records response time
+        of the endpoint in self.latency. Timeout limits single socket
+        operations, and is lowered to the time left until expires.
         """
         methods = {"GET", "POST", "PUT", "DELETE"}
 
         if method not in methods:
             raise ValueError("Unrecognized method: {}".format(method))
+        remaining = self._remaining(expires, url)
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self._check_fork()
         request = requests.Request(method, url, headers=headers, json=data)
         request = self.session.prepare_request(request)
         try:
-            request = self.session.send(request)
+            start = time.monotonic()
+            try:
+                request = self.session.send(request, timeout=timeout)
+            except requests.Timeout:
+                if expires is None:
+                    raise
+                raise DeadlineExceeded("Deadline exceeded for url: {}".format(url), self)
+            self.latency.record(LatencyStats.key(method, urlsplit(url).path),
+                                time.monotonic() - start)
+            # Socket timeouts do not limit a slowly sent response.
+            self._remaining(expires, url)
             logging.info("Sending request, url: {} headers: {} status: {} response:\n{}".format(
                 url, str(headers), request.status_code, request.json()))
             if not request.json()['success'] or not request.ok:
@@ -115,6 +192,80 @@ class E24sess():
             raise ApiRequestFailed("Status Code: {} \n No Json response".format(
                                    request.status_code), self)
 
+    def _timed_dispatch(self, method, headers, url, data, expires=None, hedge=False):
+        """Sends the request from a worker thread, raising DeadlineExceeded if
+        it is not answered before expires. With hedge, if the request is not
+        answered within the hedge delay of its endpoint, a second one is sent,
+        and the first successful response is returned. Abandoned requests
+        finish in the background within the bounded session executor, and
+        always use a finite socket timeout (self.timeout), so stalled
+        connections cannot hold worker threads forever.
+        """
+        self._remaining(expires, url)
+        executor = self._get_executor()
+        pending = {executor.submit(self._request_dispatch, method, headers, url,
+                                   data, expires, self.timeout)}
+        try:
+            if hedge:
+                delay = self.latency.hedge_delay(LatencyStats.key(method, urlsplit(url).path))
+                if expires is not None:
+                    delay = min(delay, self._remaining(expires, url))
+
+                done, _ = wait(pending, timeout=delay)
+                if not done:
+                    logging.info("No response from {} in {:.3f}s, sending hedged request".format(
+                        url, delay))
+                    pending.add(executor.submit(self._request_dispatch, method, headers,
+                                                url, data, expires, self.timeout))
+
+            while pending:
+                timeout = None if expires is None else self._remaining(expires, url)
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded("Deadline exceeded for url: {}".format(url), self)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as error:
+                        failure = error
+            raise failure
+        finally:
+            # Requests still queued are not needed anymore.
+            for future in pending:
+                future.cancel()
+
+    def _get_executor(self):
+        """Returns the thread pool of this session, created on first use."""
+        self._check_fork()
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _remaining(self, expires, url):
+        """Returns seconds left until expires, or None if there is no deadline.
+        Raises DeadlineExceeded if it has already passed."""
+        if expires is None:
+            return None
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline exceeded for url: {}".format(url), self)
+        return remaining
+
+    def _check_fork(self):
+        """Replaces requests.Session inherited from a parent process, as its
+        pooled connections are shared with the parent after fork().
+        """
+        if self._pid != os.getpid():
+            logging.info("Fork detected, creating new transport for endpoint {}".format(
+                self.endpoint))
+            self.session = requests.Session()
+            # Worker threads do not survive fork, the lock may have been held.
+            self._executor = None
+            self._executor_lock = threading.Lock()
+            self.latency.after_fork()
+            self._pid = os.getpid()
+
     def resource_search(self, type, id=None, label=None):
         """Generic search function, returns uniformally formatted json responses
         independently. As a search function, it handles not finding a resources 
@@ -128,16 +279,14 @@ class E24sess():
             try:
                 r = self.api_request('GET', url)
 
+            except DeadlineExceeded:
+                raise
             except ApiRequestFailed:
                 return False
             return r.json()[type]
 
         elif label:
-            url = "/v2/{}".format(TYPEMAP[type]['urlname'])
-
-            r = self.api_request('GET', url)
-
-            for resource in r.json()[TYPEMAP[type]['jsonname']]:
+            for resource in self.list_resources(type):
                 if resource['label'] == label:
                     return resource
             return False
@@ -145,6 +294,65 @@ class E24sess():
         else:
             raise ValueError('No ID or label provided.')
 
+    def list_resources(self, type):
+        """Returns json data of all resources of given type with a single
+        request."""
+        url = "/v2/{}".format(TYPEMAP[type]['urlname'])
+
+        r = self.api_request('GET', url)
+        return r.json()[TYPEMAP[type]['jsonname']]
+
+    def refresh(self, objs):
+        """Updates given ApiObjects using one list request per resource type,
+        instead of one request per object like ApiObject.update(). Objects no
+        longer returned by the API are removed from self.objects and returned
+        as a list.
+
+        Storage volumes of refreshed vms are refreshed with them, and volumes
+        are listed first, so vms build newly attached StorageVolume objects
+        from that list instead of requesting each one.
+        """
+        by_type = {}
+        seen = set()
+        for obj in objs:
+            for item in [obj] + list(getattr(obj, 'storage_volumes', [])):
+                if item.id not in seen:
+                    seen.add(item.id)
+                    by_type.setdefault(item.type, []).append(item)
+        if 'virtual_machine' in by_type:
+            by_type.setdefault('storage_volume', [])
+
+        removed = []
+        for type in sorted(by_type, key=lambda type: type != 'storage_volume'):
+            type_objs = by_type[type]
+            resources = self.list_resources(type)
+            self.inventory.load(type, resources)
+            payloads = {resource['id']: resource for resource in resources}
+
+            for obj in type_objs:
+                if obj.id in payloads:
+                    obj._apply_data(payloads[obj.id])
+                else:
+                    self.objects.pop(obj.id, None)
+                    removed.append(obj)
+                    logging.info("ApiObject {} id: {} no longer exists, removed".format(
+                        obj.type, obj.id))
+
+        return removed
+
+    def refresh_all(self):
+        """Refreshes every ApiObject registered within this session."""
+        return self.refresh(list(self.objects.values()))
+
+    def query(self, type, refresh=False):
+        """Returns an inventory Query over all resources of given type. The
+        list of resources is fetched once and cached in self.inventory, until
+        refresh is requested or the type is refreshed with refresh().
+        """
+        if refresh or type not in self.inventory:
+            self.inventory.load(type, self.list_resources(type))
+        return self.inventory.query(type)
+
     def _set_zone(self):
         """This function sets proper zone id for selected endpoint. This 
         attribute is initalized lazily since for the time being only create_vm
@@ -22,7 +22,10 @@ import pytest
 import responses
 import hmac, hashlib, base64
 import json
+import os
 import requests
+import threading
+import time
 
 from unittest import mock
 from email.utils import formatdate
@@ -193,6 +196,162 @@ class TestApiCall:
         with pytest.raises(e24py.session.ApiRequestFailed):
             session_setup.api_request('GET', '/v2/virtual-machines-2')
 
+    @responses.activate
+    def test_deadline_exceeded(self, session_setup):
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup._request_dispatch('GET', {}, "https://eu-poland-1poznan.api.e24cloud.com/v2/regions",
+                                            None, expires=0)
+
+        responses.add(responses.GET, "https://eu-poland-1poznan.api.e24cloud.com/v2/regions",
+                      body=requests.Timeout())
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('GET', '/v2/regions', deadline=10)
+
+    @responses.activate
+    def test_get_retries(self, session_setup):
+        url = "https://eu-poland-1poznan.api.e24cloud.com/v2/regions"
+        responses.add(responses.GET, url, body=requests.ConnectionError())
+        responses.add(responses.GET, url, json={'success': True}, status=200)
+        responses.add(responses.PUT, url, body=requests.ConnectionError())
+        responses.add(responses.PUT, url, json={'success': True}, status=200)
+        session_setup.retries = 1
+        session_setup.retry_backoff = 0.01
+
+        with mock.patch.object(session_setup, "_sign", wraps=session_setup._sign) as sign:
+            assert session_setup.api_request('GET', '/v2/regions').json() == {'success': True}
+            assert sign.call_count == 2
+        assert len(responses.calls) == 2
+        assert len(session_setup.latency.samples["GET /v2/regions"]) == 1
+
+        with pytest.raises(requests.ConnectionError):
+            session_setup.api_request('PUT', '/v2/regions', {'success': True})
+        assert len(responses.calls) == 3
+
+    def test_deadline_slow_response(self, session_setup):
+        response = mock.MagicMock()
+        response.json.return_value = {'success': True}
+
+        def slow_send(request, timeout=None):
+            time.sleep(0.3)
+            return response
+
+        session_setup.session.send = slow_send
+
+        start = time.monotonic()
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('PUT', '/v2/virtual-machines', {'success': True}, deadline=0.1)
+        assert time.monotonic() - start < 0.3
+
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup._request_dispatch('GET', {}, "https://eu-poland-1poznan.api.e24cloud.com/v2/regions",
+                                            None, expires=time.monotonic() + 0.1)
+
+        assert session_setup.api_request('GET', '/v2/regions', deadline=1) is response
+
+    def test_retry_backoff_capped_by_deadline(self, session_setup):
+        session_setup._request_dispatch = mock.MagicMock(side_effect=requests.ConnectionError())
+        session_setup.retries = 5
+        session_setup.retry_backoff = 10
+
+        start = time.monotonic()
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('GET', '/v2/regions', deadline=0.2)
+        assert time.monotonic() - start < 1
+
+    def test_resource_search_deadline(self, session_setup):
+        session_setup.api_request = mock.MagicMock(side_effect=e24py.session.DeadlineExceeded())
+
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.resource_search(type='virtual_machine', id="test_vm_id")
+
+    def test_executor_reused(self, session_setup):
+        session_setup._request_dispatch = mock.MagicMock(return_value="response")
+
+        session_setup.api_request('GET', '/v2/regions', hedge=True)
+        executor = session_setup._executor
+        session_setup.api_request('GET', '/v2/regions', hedge=True)
+        assert session_setup._executor is executor
+        assert executor._max_workers == session_setup.max_workers
+
+        with mock.patch("e24py.session.os.getpid", return_value=-1):
+            session_setup.api_request('GET', '/v2/regions', hedge=True)
+        assert session_setup._executor is not executor
+
+    def test_hedged_request(self, session_setup):
+        session_setup.latency.default = 0.01
+        calls = []
+
+        def dispatch(method, headers, url, data, expires=None, timeout=None):
+            # Requests sent from worker threads always have a socket timeout.
+            assert method != 'GET' or timeout == session_setup.timeout
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+
+        session_setup._request_dispatch = dispatch
+
+        assert session_setup.api_request('GET', '/v2/virtual-machines', hedge=True) == "fast"
+        assert len(calls) == 2
+
+        calls.clear()
+        assert session_setup.api_request('PUT', '/v2/virtual-machines', hedge=True) == "slow"
+        assert len(calls) == 1
+
+    def test_queued_hedge_cancelled(self, session_setup):
+        session_setup.max_workers = 1
+        session_setup.latency.default = 0.01
+        calls = []
+
+        def dispatch(method, headers, url, data, expires=None, timeout=None):
+            calls.append(url)
+            time.sleep(0.3)
+
+        session_setup._request_dispatch = dispatch
+
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('GET', '/v2/virtual-machines', deadline=0.1, hedge=True)
+        time.sleep(0.4)
+        # The hedged request waited in the queue behind the first one and was dropped.
+        assert len(calls) == 1
+
+    def test_zero_deadline(self, session_setup):
+        session_setup._request_dispatch = mock.MagicMock()
+
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('GET', '/v2/regions', deadline=0)
+        assert not session_setup._request_dispatch.called
+
+    def test_latency_lock_reset_after_fork(self, session_setup):
+        session_setup.latency._lock.acquire()
+
+        with mock.patch("e24py.session.os.getpid", return_value=-1):
+            session_setup._check_fork()
+        assert not session_setup.latency._lock.locked()
+
+    def test_hedged_request_deadline(self, session_setup):
+        session_setup._request_dispatch = lambda *args: time.sleep(0.5)
+        session_setup.latency.default = 0.01
+
+        with pytest.raises(e24py.session.DeadlineExceeded):
+            session_setup.api_request('GET', '/v2/virtual-machines', deadline=0.1, hedge=True)
+
+    def test_latency_stats(self):
+        stats = e24py.session.LatencyStats(min_samples=10, default=2.0)
+
+        assert stats.key("GET", "/v2/virtual-machines") == "GET /v2/virtual-machines"
+        assert stats.key("POST", "/v2/virtual-machines/test_id/poweron") == "POST /v2/virtual-machines/*/poweron"
+
+        for i in range(9):
+            stats.record("GET /v2/virtual-machines", i / 10)
+        assert stats.hedge_delay("GET /v2/virtual-machines") == 2.0
+
+        for i in range(9, 100):
+            stats.record("GET /v2/virtual-machines", i / 10)
+        assert stats.get_percentile("GET /v2/virtual-machines") == 9.4
+        assert stats.hedge_delay("GET /v2/virtual-machines") == 9.4
+
 
 class TestSessionUtilities:
     """Tests e24py.E24sess utlilities methods (both public and private."""
@@ -273,6 +432,71 @@ class TestSessionUtilities:
         assert r == "test_create_vm"
         session_setup.api_request.assert_called_once_with('PUT', "/v2/virtual-machines", expected_data)
 
+    @responses.activate
+    def test_refresh(self, session_setup, api_call_mock):
+        rv, data = api_call_mock("test_refresh_storage_volumes")
+
+        session_setup.resource_search = mock.MagicMock()
+        session_setup.resource_search.side_effect = [{"id": "test_storage_id", "label": None, "size": 40},
+                                                     {"id": "test_removed_id", "label": None, "size": 40}]
+        storage = e24py.StorageVolume(id="test_storage_id", session=session_setup)
+        removed = e24py.StorageVolume(id="test_removed_id", session=session_setup)
+
+        session_setup.api_request = mock.MagicMock()
+        session_setup.api_request.return_value = rv
+
+        assert session_setup.refresh_all() == [removed]
+        session_setup.api_request.assert_called_once_with('GET', "/v2/storage-volumes")
+        assert storage.size == 60
+        assert storage.label == "updated_label"
+        assert session_setup.objects == {"test_storage_id": storage}
+
+    def test_refresh_virtual_machine(self, session_setup):
+        vm_data = {"id": "test_vm_id", "label": "test_label", "state": "offline", "cores": 1, "ram": 512,
+                   "storage_volumes": [{"id": "test_storage_id", "size": 40}]}
+        storage_data = {"id": "test_storage_id", "label": None, "size": 40}
+
+        session_setup.resource_search = mock.MagicMock()
+        session_setup.resource_search.side_effect = lambda type, id, label: \
+            vm_data if type == 'virtual_machine' else storage_data
+        vm = e24py.VirtualMachine(id="test_vm_id", session=session_setup)
+        storage = vm.storage_volumes[0]
+
+        updated = dict(vm_data, state="online", cores=2)
+        session_setup.list_resources = mock.MagicMock()
+        session_setup.list_resources.side_effect = lambda type: \
+            [updated] if type == 'virtual_machine' else [dict(storage_data, size=60)]
+
+        assert session_setup.refresh_all() == []
+        assert vm.state == "online"
+        assert vm.cores == 2
+        assert vm.storage_volumes == [storage]
+        assert storage.size == 60
+
+        session_setup.api_request = mock.MagicMock()
+        vm.delete()
+        session_setup.api_request.assert_called_once_with('DELETE', "/v2/virtual-machines/test_vm_id")
+        assert session_setup.objects == {}
+
+    def test_refresh_virtual_machine_new_volume(self, session_setup):
+        vm_data = {"id": "test_vm_id", "label": "test_label", "state": "online", "cores": 1, "ram": 512,
+                   "storage_volumes": []}
+
+        session_setup.resource_search = mock.MagicMock(return_value=vm_data)
+        vm = e24py.VirtualMachine(id="test_vm_id", session=session_setup)
+
+        attached = dict(vm_data, storage_volumes=[{"id": "test_storage_id", "size": 40}])
+        session_setup.list_resources = mock.MagicMock()
+        session_setup.list_resources.side_effect = lambda type: \
+            [attached] if type == 'virtual_machine' else [{"id": "test_storage_id", "label": None, "size": 40}]
+
+        assert session_setup.refresh([vm]) == []
+        session_setup.resource_search.assert_called_once_with('virtual_machine', "test_vm_id", '')
+        assert [call[0][0] for call in session_setup.list_resources.call_args_list] == \
+            ['storage_volume', 'virtual_machine']
+        assert vm.storage_volumes[0].size == 40
+        assert session_setup.objects["test_storage_id"] is vm.storage_volumes[0]
+
 
 class TestApiObjects:
     """Tests e24py.Apiobjects instancing and methods. We skip testing ApiObject class, as it is not called directly."""
@@ -375,3 +599,268 @@ class TestApiObjects:
 
         with pytest.raises(AttributeError):
              vm = e24py.VirtualMachine(id="test_vm_id")
+
+    def test_wait_for_then_delete(self, session_setup):
+        vm_data = {"id": "test_vm_id", "label": "test_label", "state": "creating", "cores": 1, "ram": 512,
+                   "storage_volumes": [{"id": "test_storage_id", "size": 40}]}
+        storage_data = {"id": "test_storage_id", "label": None, "size": 40}
+
+        session_setup.resource_search = mock.MagicMock()
+        session_setup.resource_search.side_effect = lambda type, id, label: \
+            vm_data if type == 'virtual_machine' else storage_data
+        vm = e24py.VirtualMachine(id="test_vm_id", session=session_setup)
+        storage = vm.storage_volumes[0]
+
+        creating, online = mock.MagicMock(), mock.MagicMock()
+        creating.json.return_value = {"virtual_machine": vm_data}
+        online.json.return_value = {"virtual_machine": dict(vm_data, state="online")}
+        session_setup.api_request = mock.MagicMock()
+        session_setup.api_request.side_effect = [creating, online, mock.MagicMock()]
+
+        assert vm.wait_for("state", "online", interval=0) is vm
+        assert vm.state == "online"
+        assert vm.storage_volumes == [storage]
+
+        vm.delete()
+        session_setup.api_request.assert_called_with('DELETE', "/v2/virtual-machines/test_vm_id")
+        assert session_setup.objects == {}
+
+
+class TestPipeline:
+    """Tests e24py.Pipeline dependency ordering, retries and rollback."""
+
+    def test_pipeline_dependencies(self):
+        pipeline = e24py.Pipeline(max_workers=4)
+        order = []
+
+        def step(name):
+            def _step(*args):
+                order.append(name)
+                return (name,) + args
+            return _step
+
+        pipeline.add_step("create", step("create"))
+        pipeline.add_step("wait", step("wait"), requires=["create"])
+        pipeline.add_step("other", step("other"))
+        pipeline.add_step("image", step("image"), requires=["wait", "other"])
+
+        results = pipeline.run()
+
+        assert results["image"] == ("image", ("wait", ("create",)), ("other",))
+        assert order.index("create") < order.index("wait") < order.index("image")
+        assert order.index("other") < order.index("image")
+
+    def test_pipeline_parallel_steps(self):
+        pipeline = e24py.Pipeline(max_workers=2)
+        barrier = threading.Barrier(2, timeout=5)
+
+        # Both steps only pass the barrier if they run at the same time.
+        pipeline.add_step("first", lambda: barrier.wait() is not None)
+        pipeline.add_step("second", lambda: barrier.wait() is not None)
+
+        assert pipeline.run() == {"first": True, "second": True}
+
+    def test_pipeline_unknown_dependency(self):
+        pipeline = e24py.Pipeline()
+        pipeline.add_step("create", lambda: None)
+
+        with pytest.raises(ValueError):
+            pipeline.add_step("wait", lambda x: x, requires=["nonexistent"])
+        with pytest.raises(ValueError):
+            pipeline.add_step("create", lambda: None)
+
+    def test_pipeline_retries(self):
+        pipeline = e24py.Pipeline()
+        flaky = mock.MagicMock(side_effect=[e24py.session.ApiRequestFailed(), "test_vm_id"])
+
+        pipeline.add_step("create", flaky, retries=1)
+
+        assert pipeline.run() == {"create": "test_vm_id"}
+        assert flaky.call_count == 2
+
+    def test_pipeline_rollback(self):
+        pipeline = e24py.Pipeline(max_workers=1)
+        rollback = mock.MagicMock()
+        failing = mock.MagicMock(side_effect=e24py.session.ApiRequestFailed())
+
+        pipeline.add_step("create", lambda: "test_vm_id", rollback=rollback)
+        pipeline.add_step("detach", failing, requires=["create"], retries=2)
+        pipeline.add_step("image", lambda x: x, requires=["detach"])
+
+        with pytest.raises(e24py.PipelineFailed) as error:
+            pipeline.run()
+
+        assert error.value.step == "detach"
+        assert "image" not in error.value.results
+        assert failing.call_count == 3
+        rollback.assert_called_once_with("test_vm_id")
+
+
+class TestInventory:
+    """Tests e24py.E24sess.query and inventory filtering and aggregates."""
+
+    vms = [{"id": "vm_1", "label": "web", "state": "online", "cores": 2, "ram": 1024},
+           {"id": "vm_2", "label": "db", "state": "online", "cores": 8, "ram": 8192},
+           {"id": "vm_3", "label": "batch", "state": "offline", "cores": 4, "ram": 4096},
+           {"id": "vm_4", "label": "new", "state": "creating", "cores": None, "ram": None}]
+
+    def test_query_cached(self, session_setup):
+        session_setup.list_resources = mock.MagicMock(return_value=self.vms)
+
+        session_setup.query('virtual_machine')
+        session_setup.query('virtual_machine')
+        session_setup.list_resources.assert_called_once_with('virtual_machine')
+
+        session_setup.query('virtual_machine', refresh=True)
+        assert session_setup.list_resources.call_count == 2
+
+    def test_query_where(self, session_setup):
+        session_setup.list_resources = mock.MagicMock(return_value=self.vms)
+        query = session_setup.query('virtual_machine')
+
+        assert query.count() == 4
+        assert query.where(state='online').ids() == ["vm_1", "vm_2"]
+        assert query.where(state='online', cores__gte=4).ids() == ["vm_2"]
+        assert query.where(cores__gt=2).where(ram__lt=8192).ids() == ["vm_3"]
+        assert query.where(cores__lte=4).ids() == ["vm_1", "vm_3"]
+        assert query.where(label__in=["web", "new"]).ids() == ["vm_1", "vm_4"]
+        assert query.where(id="vm_3").all() == [self.vms[2]]
+        assert not query.where(state='deleting').all()
+
+        with pytest.raises(ValueError):
+            query.where(cores__between=4)
+        with pytest.raises(ValueError):
+            query.where(label__in="web")
+
+    def test_query_unhashable_value(self, session_setup):
+        session_setup.list_resources = mock.MagicMock(return_value=self.vms)
+        query = session_setup.query('virtual_machine')
+
+        # state is indexed, id is not - both must give the same answer
+        assert query.where(state=['online']).ids() == []
+        assert query.where(id=['vm_1']).ids() == []
+        assert query.where(state__in=[['online'], 'offline']).ids() == ["vm_3"]
+
+    def test_query_range_on_text_field(self, session_setup):
+        session_setup.list_resources = mock.MagicMock(return_value=self.vms)
+        query = session_setup.query('virtual_machine')
+
+        # label is indexed, id is not - both must be scanned for range filters on text
+        assert query.where(label__gte="m").ids() == ["vm_1", "vm_4"]
+        assert query.where(id__gt="vm_2").ids() == ["vm_3", "vm_4"]
+        assert query.where(state__lt="online").ids() == ["vm_3", "vm_4"]
+
+    def test_query_aggregates(self, session_setup):
+        session_setup.list_resources = mock.MagicMock(return_value=self.vms)
+        query = session_setup.query('virtual_machine')
+
+        assert query.sum('ram') == 13312
+        assert query.sum('ram', by='state') == {"online": 9216, "offline": 4096}
+        assert query.where(state='online').sum('cores') == 10
+        assert query.count(by='state') == {"online": 2, "offline": 1, "creating": 1}
+
+    def test_query_nested_field(self, session_setup):
+        volumes = [{"id": "sv_1", "size": 40, "virtual_machine": {"id": "vm_1"}},
+                   {"id": "sv_2", "size": 60, "virtual_machine": {"id": "vm_1"}},
+                   {"id": "sv_3", "size": 20, "virtual_machine": None}]
+        session_setup.list_resources = mock.MagicMock(return_value=volumes)
+        query = session_setup.query('storage_volume')
+
+        assert query.count(by='virtual_machine.id') == {"vm_1": 2, None: 1}
+        assert query.where(size__gte=40).sum('size', by='virtual_machine.id') == {"vm_1": 100}
+
+
+class TestSessionPool:
+    """Tests fork detection in e24py.E24sess and e24py.SessionPool shared caches."""
+
+    def test_session_rebuilt_after_fork(self, session_setup):
+        transport = session_setup.session
+
+        session_setup._check_fork()
+        assert session_setup.session is transport
+
+        with mock.patch("e24py.session.os.getpid", return_value=-1):
+            session_setup._check_fork()
+        assert session_setup.session is not transport
+        assert session_setup._pid == -1
+
+    def test_pool_session_per_process(self, tmpdir):
+        pool = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+
+        assert pool.session is pool.session
+        session = pool.session
+
+        with mock.patch("e24py.pool.os.getpid", return_value=-1):
+            assert pool.session is not session
+
+        with pytest.raises(KeyError):
+            e24py.SessionPool("jkh432k4g32kg4")
+
+    def test_pool_pickle(self, tmpdir):
+        import pickle
+
+        pool = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+        pool.session
+
+        copy = pickle.loads(pickle.dumps(pool))
+        assert copy._session is None
+        assert copy.cache.path == str(tmpdir)
+
+    def test_shared_cache(self, tmpdir):
+        cache = e24py.SharedCache(str(tmpdir))
+
+        assert cache.get("missing") is None
+        cache.set("test_key", {"a": 1})
+        assert e24py.SharedCache(str(tmpdir)).get("test_key") == {"a": 1}
+        assert e24py.SharedCache(str(tmpdir), max_age=-1).get("test_key") is None
+        cache.clear("test_key")
+        assert cache.get("test_key") is None
+
+    def test_default_cache_path_per_account(self, tmpdir):
+        with mock.patch("e24py.pool.tempfile.gettempdir", return_value=str(tmpdir)):
+            with mock.patch("e24py.pool.APIKEY", "access_key_1"):
+                pool_1 = e24py.SessionPool(set_default=False)
+            with mock.patch("e24py.pool.APIKEY", "access_key_2"):
+                pool_2 = e24py.SessionPool(set_default=False)
+
+        assert pool_1.cache.path != pool_2.cache.path
+        assert "access_key" not in pool_1.cache.path
+        assert os.stat(pool_1.cache.path).st_mode & 0o777 == 0o700
+
+    def test_shared_cache_unsafe_directory(self, tmpdir):
+        path = tmpdir.mkdir("shared")
+        path.chmod(0o777)
+        with pytest.raises(PermissionError):
+            e24py.SharedCache(str(path))
+
+        path.chmod(0o700)
+        with mock.patch("e24py.pool.os.getuid", return_value=os.getuid() + 1):
+            with pytest.raises(PermissionError):
+                e24py.SharedCache(str(path))
+
+    def test_label_index_shared(self, tmpdir):
+        resources = [{"id": "vm_1", "label": "web"}, {"id": "vm_2", "label": "web"},
+                     {"id": "vm_3", "label": None}]
+        worker_1 = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+        worker_2 = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+        worker_1.session.list_resources = mock.MagicMock(return_value=resources)
+        worker_2.session.list_resources = mock.MagicMock(return_value=resources)
+
+        assert worker_1.label_index('virtual_machine') == {"web": "vm_1"}
+        assert worker_2.resource_id('virtual_machine', "web") == "vm_1"
+        assert worker_2.resource_id('virtual_machine', "db") is None
+        worker_1.session.list_resources.assert_called_once_with('virtual_machine')
+        assert not worker_2.session.list_resources.called
+
+        worker_2.label_index('virtual_machine', refresh=True)
+        worker_2.session.list_resources.assert_called_once_with('virtual_machine')
+
+    def test_get_os_shared(self, tmpdir):
+        worker_1 = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+        worker_2 = e24py.SessionPool(cache_path=str(tmpdir), set_default=False)
+        worker_1.session.get_os = mock.MagicMock(return_value={2599: {"label": "Ubuntu 18.04"}})
+        worker_2.session.get_os = mock.MagicMock()
+
+        assert worker_1.get_os() == {"2599": {"label": "Ubuntu 18.04"}}
+        assert worker_2.get_os() == {"2599": {"label": "Ubuntu 18.04"}}
+        assert not worker_2.session.get_os.called